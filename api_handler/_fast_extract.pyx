@@ -0,0 +1,76 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""Compiled per-entity extraction for fetch_data.
+
+Mirrors fetch_data._extract_vehicle, which is used when this module has not
+been built. Build in place with: python setup.py build_ext --inplace
+"""
+
+cimport cython
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef list _carriage_details(object raw):
+    # Materialise the RepeatedCompositeContainer once, then index a plain list
+    cdef list carriages = list(raw)
+    cdef Py_ssize_t i, n = len(carriages)
+    cdef list out = [None] * n
+    cdef object c
+    for i in range(n):
+        c = carriages[i]
+        out[i] = {
+            'id': c.id,
+            'label': c.label,
+            'occupancy_status': c.occupancy_status,
+            'occupancy_percentage': c.occupancy_percentage,
+            'carriage_sequence': c.carriage_sequence,
+        }
+    return out
+
+
+cpdef dict extract_vehicle(object entity, object header_ts):
+    cdef object v = entity.vehicle
+    cdef object t = v.trip
+    cdef object w = v.vehicle
+    cdef object p = v.position
+    cdef list mcd = _carriage_details(v.multi_carriage_details)
+    cdef str trip_id = t.trip_id
+    cdef str route_id = t.route_id
+    cdef str start_time = t.start_time
+    cdef str start_date = t.start_date
+    cdef str vehicle_id = w.id
+    cdef str label = w.label
+    cdef str license_plate = w.license_plate
+    cdef str stop_id = v.stop_id
+
+    return {
+        'id': entity.id,
+        'trip': {
+            'trip_id': trip_id,
+            'route_id': route_id,
+            'direction_id': t.direction_id,
+            'start_time': start_time,
+            'start_date': start_date,
+            'schedule_relationship': t.schedule_relationship,
+        },
+        'vehicle': {
+            'id': vehicle_id,
+            'label': label,
+            'license_plate': license_plate,
+        },
+        'position': {
+            'latitude': p.latitude,
+            'longitude': p.longitude,
+            'bearing': p.bearing,
+            'odometer': p.odometer,
+            'speed': p.speed,
+        },
+        'current_stop_sequence': v.current_stop_sequence,
+        'stop_id': stop_id,
+        'current_status': v.current_status,
+        'timestamp': header_ts,
+        'congestion_level': v.congestion_level,
+        'occupancy_status': v.occupancy_status,
+        'occupancy_percentage': v.occupancy_percentage,
+        'multi_carriage_details': mcd,
+    }
@@ -0,0 +1,92 @@
+import gzip
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+from google.transit import gtfs_realtime_pb2
+
+def build_vehicle_entity(entity_id='entity-1'):
+    """Build a FeedEntity carrying a populated VehiclePosition."""
+    entity = gtfs_realtime_pb2.FeedEntity(id=entity_id)
+    vehicle = entity.vehicle
+    vehicle.trip.trip_id = 'trip-1'
+    vehicle.trip.route_id = 'route-1'
+    vehicle.trip.direction_id = 1
+    vehicle.trip.start_time = '08:15:00'
+    vehicle.trip.start_date = '20240101'
+    vehicle.vehicle.id = 'bus-42'
+    vehicle.vehicle.label = 'Route 1'
+    vehicle.position.latitude = 51.5
+    vehicle.position.longitude = -0.125
+    vehicle.position.bearing = 90.0
+    vehicle.stop_id = 'stop-7'
+    vehicle.current_stop_sequence = 7
+    return entity
+
+def build_vehicle_feed(timestamp=0, entity_id='entity-1'):
+    """Build a FeedMessage holding a single build_vehicle_entity() entity."""
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = '2.0'
+    if timestamp:
+        feed.header.timestamp = timestamp
+    feed.entity.append(build_vehicle_entity(entity_id))
+    return feed
+
+class FlakyFeedHandler(BaseHTTPRequestHandler):
+    """Serve 503s for the server's first `failures` requests, then a valid feed (gzipped if accepted)."""
+
+    def do_GET(self):
+        self.server.request_count += 1
+        if self.server.request_count <= self.server.failures:
+            self.send_response(503)
+            if self.server.retry_after:
+                self.send_header('Retry-After', self.server.retry_after)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        body = build_vehicle_feed(entity_id=self.server.entity_id).SerializeToString()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-protobuf')
+        if self.server.truncate:
+            # Promise the full body but close the connection halfway through it
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+            self.server.gzipped = True
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def flaky_feed_server():
+    """Start a local feed server that fails a given number of requests first."""
+    servers = []
+
+    def start(failures, truncate=False, retry_after=None, entity_id='entity-1', delay=0):
+        server = HTTPServer(('127.0.0.1', 0), FlakyFeedHandler)
+        server.failures = failures
+        server.request_count = 0
+        server.gzipped = False
+        server.truncate = truncate
+        server.retry_after = retry_after
+        server.entity_id = entity_id
+        server.delay = delay
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f'http://127.0.0.1:{server.server_port}/gtfs-realtime', server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
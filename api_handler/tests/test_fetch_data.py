@@ -1,15 +1,28 @@
 import pytest  # Import pytest for retry decorator
-from unittest.mock import patch, Mock
+from unittest.mock import patch, MagicMock
 from pydantic import ValidationError
 from google.protobuf.message import DecodeError  
-from fetch_data import fetch_gtfs_rt_data  
+from google.transit import gtfs_realtime_pb2
+from fetch_data import fetch_gtfs_rt_data, fetch_gtfs_rt_data_async, fetch_many, extract_vehicle, _extract_vehicle, _VEH_LIST_ADAPTER
 import requests
+import asyncio
+import time
+from conftest import build_vehicle_entity, build_vehicle_feed
 
 # Define a function to read the real GTFS RT binary Protobuf message from your file
 def get_real_protobuf_response(file_path):
     with open(file_path, 'rb') as file:
         return file.read()
 
+def feed_response(content, content_type='application/x-protobuf', status_code=200):
+    """Build a mock requests response carrying the given body and content type."""
+    mock_response = MagicMock()
+    mock_response.__enter__.return_value = mock_response
+    mock_response.status_code = status_code
+    mock_response.content = content
+    mock_response.headers = {'Content-Type': content_type}
+    return mock_response
+
 # ---------------- Successful Data Handling Tests ----------------
 
 class TestSuccessfulDataHandling:
@@ -17,18 +30,14 @@ class TestSuccessfulDataHandling:
 
     # Test Case ID: TC_001
     @pytest.mark.retry(count=2, delay=0.5)
-    @patch('fetch_data.requests.get')
+    @patch('fetch_data.requests.Session.get')
     def test_successful_fetch_data_returns_correct_structure(self, mock_get):
         """
         Test Case ID: TC_001
         Description: Test that valid GTFS RT data is fetched and parsed successfully.
         Expected Outcome: The function returns a dictionary containing keys 'vehicle', 'trip_update', and 'alert'.
         """
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.content = get_real_protobuf_response('/home/gtfs_rt_user/gtfs-rt-pipeline/scripts/gtfs_rt_sample.bin')
-        mock_response.headers = {'Content-Type': 'application/x-protobuf'}
-        mock_get.return_value = mock_response
+        mock_get.return_value = feed_response(get_real_protobuf_response('/home/gtfs_rt_user/gtfs-rt-pipeline/scripts/gtfs_rt_sample.bin'))
 
         result = fetch_gtfs_rt_data('http://example.com/gtfs-realtime')
         assert isinstance(result, dict)
@@ -36,30 +45,179 @@ class TestSuccessfulDataHandling:
         assert 'trip_update' in result
         assert 'alert' in result
 
+    @pytest.mark.retry(count=2, delay=0.5)
+    @patch('fetch_data.requests.Session.get')
+    def test_successful_fetch_returns_extracted_vehicle(self, mock_get):
+        """
+        Test Case ID: TC_016
+        Description: Test that a feed with a vehicle entity returns the extracted vehicle dictionary.
+        Expected Outcome: The 'vehicle' key holds the entity's fields stamped with the feed header timestamp.
+        """
+        feed = build_vehicle_feed(timestamp=1700000000)
+        mock_get.return_value = feed_response(feed.SerializeToString())
+
+        result = fetch_gtfs_rt_data('http://example.com/gtfs-realtime')
+        assert result['vehicle'] == _extract_vehicle(feed.entity[0], 1700000000)
+        assert result['trip_update'] is None
+        assert result['alert'] is None
+
+    @patch('fetch_data.requests.Session.get')
+    def test_content_type_with_parameters_is_accepted(self, mock_get):
+        """
+        Test Case ID: TC_026
+        Description: Test that a protobuf content type carrying parameters is accepted.
+        Expected Outcome: A response with 'application/x-protobuf; charset=binary' is parsed successfully.
+        """
+        feed = build_vehicle_feed()
+        mock_get.return_value = feed_response(feed.SerializeToString(), content_type='application/x-protobuf; charset=binary')
+
+        result = fetch_gtfs_rt_data('http://example.com/gtfs-realtime')
+        assert result['vehicle']['id'] == 'entity-1'
+
+    def test_compressed_response_is_decoded(self, flaky_feed_server):
+        """
+        Test Case ID: TC_019
+        Description: Test that the session requests compressed feeds and decodes them transparently.
+        Expected Outcome: A gzip-encoded response is parsed into the extracted vehicle dictionary.
+        """
+        url, server = flaky_feed_server(failures=0)
+
+        result = fetch_gtfs_rt_data(url)
+
+        assert server.gzipped
+        assert result['vehicle']['id'] == 'entity-1'
+
+    def test_fetch_many_returns_results_in_url_order(self, flaky_feed_server):
+        """
+        Test Case ID: TC_020
+        Description: Test that several feeds are fetched concurrently over one aiohttp session.
+        Expected Outcome: One extracted result is returned per URL, in the order the URLs were given rather than completion order.
+        """
+        pytest.importorskip('aiohttp')
+        # The first feed answers last, so completion order differs from URL order
+        first_url, first_server = flaky_feed_server(failures=0, entity_id='first', delay=0.2)
+        second_url, second_server = flaky_feed_server(failures=0, entity_id='second')
+
+        results = asyncio.run(fetch_many([first_url, second_url]))
+
+        assert [result['vehicle']['id'] for result in results] == ['first', 'second']
+        assert first_server.request_count == 1
+        assert second_server.request_count == 1
+
+    @pytest.mark.parametrize('strict', [False, True])
+    @patch('fetch_data.requests.Session.get')
+    def test_feed_model_validation_only_runs_in_strict_mode(self, mock_get, strict):
+        """
+        Test Case ID: TC_021
+        Description: Test that the GTFS RT data model validator only runs when strict mode is enabled.
+        Expected Outcome: The feed validator is skipped by default and called once under GTFS_STRICT.
+        """
+        feed = build_vehicle_feed()
+        mock_get.return_value = feed_response(feed.SerializeToString())
+
+        with patch('fetch_data._VALIDATE', strict), patch('fetch_data._FEED_ADAPTER') as mock_adapter:
+            result = fetch_gtfs_rt_data('http://example.com/gtfs-realtime')
+
+        assert mock_adapter.validate_python.call_count == (1 if strict else 0)
+        assert result['vehicle']['id'] == 'entity-1'
+
+# ---------------- Vehicle Extraction Tests ----------------
+
+class TestVehicleExtraction:
+    """Group of tests for per-entity vehicle extraction."""
+
+    def test_extract_vehicle_reads_entity_fields(self):
+        """
+        Test Case ID: TC_014
+        Description: Test that the vehicle extractor copies the VehiclePosition fields into a dictionary.
+        Expected Outcome: The trip, vehicle and position sub-dictionaries and the header timestamp are populated.
+        """
+        data = extract_vehicle(build_vehicle_entity(), 1700000000)
+        assert data['id'] == 'entity-1'
+        assert data['trip']['trip_id'] == 'trip-1'
+        assert data['trip']['direction_id'] == 1
+        assert data['vehicle']['id'] == 'bus-42'
+        assert data['position']['longitude'] == -0.125
+        assert data['stop_id'] == 'stop-7'
+        assert data['current_stop_sequence'] == 7
+        assert data['timestamp'] == 1700000000
+        assert data['multi_carriage_details'] == []
+
+    def test_extract_vehicle_converts_carriage_details(self):
+        """
+        Test Case ID: TC_022
+        Description: Test that multi-carriage details are converted to plain dictionaries that pass validation.
+        Expected Outcome: Each CarriageDetails message becomes a dictionary and the vehicle validates.
+        """
+        entity = build_vehicle_entity()
+        carriage = entity.vehicle.multi_carriage_details.add()
+        carriage.id = 'car-1'
+        carriage.occupancy_percentage = 40
+        carriage.carriage_sequence = 1
+
+        data = _extract_vehicle(entity, 1700000000)
+
+        assert data['multi_carriage_details'] == [{
+            'id': 'car-1',
+            'label': '',
+            'occupancy_status': gtfs_realtime_pb2.VehiclePosition.NO_DATA_AVAILABLE,
+            'occupancy_percentage': 40,
+            'carriage_sequence': 1,
+        }]
+        _VEH_LIST_ADAPTER.validate_python([data])
+
+    def test_compiled_extractor_matches_fallback(self):
+        """
+        Test Case ID: TC_015
+        Description: Test that the compiled extractor agrees with the pure-Python fallback on every field.
+        Expected Outcome: Both extractors return identical dictionaries for an entity with no default-valued fields.
+        """
+        fast_extract = pytest.importorskip('_fast_extract')
+
+        entity = build_vehicle_entity()
+        vehicle = entity.vehicle
+        vehicle.trip.schedule_relationship = gtfs_realtime_pb2.TripDescriptor.ADDED
+        vehicle.vehicle.license_plate = 'AB12 CDE'
+        vehicle.position.odometer = 1234.5
+        vehicle.position.speed = 8.25
+        vehicle.current_status = gtfs_realtime_pb2.VehiclePosition.STOPPED_AT
+        vehicle.congestion_level = gtfs_realtime_pb2.VehiclePosition.RUNNING_SMOOTHLY
+        vehicle.occupancy_status = gtfs_realtime_pb2.VehiclePosition.FEW_SEATS_AVAILABLE
+        vehicle.occupancy_percentage = 65
+        for sequence in (1, 2):
+            carriage = vehicle.multi_carriage_details.add()
+            carriage.id = f'car-{sequence}'
+            carriage.label = f'Car {sequence}'
+            carriage.occupancy_status = gtfs_realtime_pb2.VehiclePosition.STANDING_ROOM_ONLY
+            carriage.occupancy_percentage = 80 + sequence
+            carriage.carriage_sequence = sequence
+
+        compiled = fast_extract.extract_vehicle(entity, 1700000000)
+        fallback = _extract_vehicle(entity, 1700000000)
+
+        assert compiled == fallback
+        assert list(compiled) == list(fallback)
+
 # ---------------- Error Handling Tests ----------------
 
 class TestErrorHandling:
     """Group of tests for handling different error scenarios."""
 
     @pytest.mark.retry(count=2, delay=0.5)
-    @patch('fetch_data.requests.get')
+    @patch('fetch_data.requests.Session.get')
     def test_correct_data_validation_raises_decode_error(self, mock_get):
         """
         Test Case ID: TC_002
         Description: Test that a malformed Protobuf response raises a DecodeError.
         Expected Outcome: A DecodeError is raised when the response content is malformed.
         """
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.content = b'\n\x12\x08\x02\x12\x08\x08\x03\x12\x03xyz\x18\x01'  # Malformed Protobuf
-        mock_response.headers = {'Content-Type': 'application/x-protobuf'}
-        mock_get.return_value = mock_response
+        mock_get.return_value = feed_response(b'\n\x12\x08\x02\x12\x08\x08\x03\x12\x03xyz\x18\x01')  # Malformed Protobuf
 
         with pytest.raises(DecodeError):
             fetch_gtfs_rt_data('http://example.com/gtfs-realtime')
 
     @pytest.mark.retry(count=2, delay=0.5)
-    @patch('fetch_data.requests.get')
+    @patch('fetch_data.requests.Session.get')
     def test_timeout_handling_raises_timeout_exception(self, mock_get):
         """
         Test Case ID: TC_003
@@ -71,7 +229,7 @@ class TestErrorHandling:
             fetch_gtfs_rt_data('http://example.com/gtfs-realtime')
 
     @pytest.mark.retry(count=2, delay=0.5)
-    @patch('fetch_data.requests.get')
+    @patch('fetch_data.requests.Session.get')
     def test_api_error_response_handling(self, mock_get):
         """
         Test Case ID: TC_004
@@ -85,7 +243,7 @@ class TestErrorHandling:
         assert 'Error fetching GTFS RT data' in str(context.value)
 
     @pytest.mark.retry(count=2, delay=0.5)
-    @patch('fetch_data.requests.get')
+    @patch('fetch_data.requests.Session.get')
     def test_invalid_url_handling_raises_invalid_url_exception(self, mock_get):
         """
         Test Case ID: TC_005
@@ -97,25 +255,21 @@ class TestErrorHandling:
             fetch_gtfs_rt_data('http://invalid-url')
 
     @pytest.mark.retry(count=2, delay=0.5)
-    @patch('fetch_data.requests.get')
+    @patch('fetch_data.requests.Session.get')
     def test_empty_response_handling_raises_exception(self, mock_get):
         """
         Test Case ID: TC_006
         Description: Test that an empty response raises an exception indicating no valid data found.
         Expected Outcome: An exception with a message containing 'No valid GTFS RT data found' is raised.
         """
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.content = b''
-        mock_response.headers = {'Content-Type': 'application/x-protobuf'}
-        mock_get.return_value = mock_response
+        mock_get.return_value = feed_response(b'')
 
         with pytest.raises(Exception) as context:
             fetch_gtfs_rt_data('http://example.com/gtfs-realtime')
         assert 'No valid GTFS RT data found' in str(context.value)
 
     @pytest.mark.retry(count=2, delay=0.5)
-    @patch('fetch_data.requests.get')
+    @patch('fetch_data.requests.Session.get')
     def test_network_interruption_handling_raises_connection_error(self, mock_get):
         """
         Test Case ID: TC_007
@@ -127,60 +281,154 @@ class TestErrorHandling:
             fetch_gtfs_rt_data('http://example.com/gtfs-realtime')
 
     @pytest.mark.retry(count=2, delay=0.5)
-    @patch('fetch_data.requests.get')
+    @patch('fetch_data.requests.Session.get')
     def test_unexpected_content_type_handling_raises_exception(self, mock_get):
         """
         Test Case ID: TC_008
         Description: Test that an unexpected content type raises an appropriate exception.
         Expected Outcome: An exception with a message containing 'Unexpected content type' is raised.
         """
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.content = b'<html>This is not a Protobuf</html>'
-        mock_response.headers = {'Content-Type': 'text/html'}
-        mock_get.return_value = mock_response
+        mock_get.return_value = feed_response(b'<html>This is not a Protobuf</html>', content_type='text/html')
 
         with pytest.raises(Exception) as context:
             fetch_gtfs_rt_data('http://example.com/gtfs-realtime')
         assert 'Unexpected content type' in str(context.value)
 
+    @patch('fetch_data.requests.Session.get')
+    def test_http_error_status_raises_exception(self, mock_get):
+        """
+        Test Case ID: TC_025
+        Description: Test that a non-2xx response status is rejected before the content type is checked.
+        Expected Outcome: An exception with a message containing 'Error fetching GTFS RT data' is raised.
+        """
+        mock_response = feed_response(b'', content_type='text/html', status_code=404)
+        mock_response.raise_for_status.side_effect = requests.exceptions.HTTPError("404 Client Error: Not Found for url: http://example.com/gtfs-realtime")
+        mock_get.return_value = mock_response
+
+        with pytest.raises(Exception) as context:
+            fetch_gtfs_rt_data('http://example.com/gtfs-realtime')
+        assert 'Error fetching GTFS RT data' in str(context.value)
+
+    @patch('fetch_data.extract_vehicle', side_effect=AttributeError('broken extractor'))
+    @patch('fetch_data.requests.Session.get')
+    def test_programming_error_propagates_without_retry(self, mock_get, mock_extract):
+        """
+        Test Case ID: TC_028
+        Description: Test that a non-transient error raised during extraction is not retried.
+        Expected Outcome: The AttributeError propagates after a single request.
+        """
+        feed = build_vehicle_feed()
+        mock_get.return_value = feed_response(feed.SerializeToString())
+
+        with pytest.raises(AttributeError):
+            fetch_gtfs_rt_data('http://example.com/gtfs-realtime')
+        assert mock_get.call_count == 1
+
+    @patch('fetch_data._VALIDATE', True)
+    @patch('fetch_data.extract_vehicle', return_value={'id': 'entity-1'})
+    @patch('fetch_data.requests.Session.get')
+    def test_strict_mode_validation_raises_validation_error(self, mock_get, mock_extract):
+        """
+        Test Case ID: TC_017
+        Description: Test that incomplete vehicle data fails validation when strict mode is enabled.
+        Expected Outcome: A ValidationError is raised for vehicle data missing required fields.
+        """
+        feed = build_vehicle_feed()
+        mock_get.return_value = feed_response(feed.SerializeToString())
+
+        with pytest.raises(ValidationError):
+            fetch_gtfs_rt_data('http://example.com/gtfs-realtime')
+
+    @patch('fetch_data.aiohttp', None)
+    def test_async_fetch_without_aiohttp_raises_import_error(self):
+        """
+        Test Case ID: TC_033
+        Description: Test that the async fetch fails clearly when aiohttp is not installed.
+        Expected Outcome: An ImportError naming aiohttp is raised before any request is made.
+        """
+        with pytest.raises(ImportError, match="aiohttp"):
+            asyncio.run(fetch_gtfs_rt_data_async(MagicMock(), 'http://example.com/gtfs-realtime'))
+
 # ---------------- Resilience and Robustness Tests ----------------
 
 class TestResilienceAndRobustness:
     """Group of tests for resilience and robustness scenarios."""
 
-    @pytest.mark.retry(count=2, delay=0.5)
-    @patch('fetch_data.requests.get')
-    def test_random_network_failures(self, mock_get):
+    def test_transient_server_errors_are_retried(self, flaky_feed_server):
         """
         Test Case ID: TC_013
-        Description: Test function resilience against random network failures.
-        Expected Outcome: The function should handle random network issues and retry appropriately.
+        Description: Test function resilience against transient server errors.
+        Expected Outcome: The session's adapter retries the 503 responses and the final successful response is parsed.
         """
+        url, server = flaky_feed_server(failures=2)
 
-        # Define a list of side effects with initial failures and a final success
-        side_effects = [
-            requests.exceptions.Timeout(),            # First call raises Timeout
-            requests.exceptions.ConnectionError(),    # Second call raises ConnectionError
-            requests.exceptions.HTTPError("500 Server Error: Internal Server Error for url: http://example.com/gtfs-realtime"),  # Third call raises HTTPError with a message
-            self.successful_response()                # Fourth call succeeds
-        ]
+        result = fetch_gtfs_rt_data(url, retries=3)
 
-        mock_get.side_effect = side_effects
+        assert server.request_count == 3
+        assert result['vehicle']['id'] == 'entity-1'
 
-        # Call the function and check it eventually succeeds
-        with pytest.raises(Exception) as context:
-            fetch_gtfs_rt_data('http://example.com/gtfs-realtime')
+    def test_retry_after_header_does_not_block_retries(self, flaky_feed_server):
+        """
+        Test Case ID: TC_030
+        Description: Test that a long Retry-After on a 503 does not stall the retry.
+        Expected Outcome: The request is retried with the normal backoff and succeeds within seconds.
+        """
+        url, server = flaky_feed_server(failures=1, retry_after='3600')
 
-        # Verify that it raises the custom exception with the correct message
-        assert 'Error fetching GTFS RT data' in str(context.value)
+        started = time.monotonic()
+        result = fetch_gtfs_rt_data(url, retries=3)
+
+        assert time.monotonic() - started < 5
+        assert server.request_count == 2
+        assert result['vehicle']['id'] == 'entity-1'
+
+    def test_truncated_body_raises_request_exception(self, flaky_feed_server):
+        """
+        Test Case ID: TC_029
+        Description: Test that a connection dropped part-way through the body is reported as a requests error.
+        Expected Outcome: A requests ChunkedEncodingError is raised rather than a raw urllib3 exception.
+        """
+        url, server = flaky_feed_server(failures=0, truncate=True)
 
-    def successful_response(self):
+        with pytest.raises(requests.exceptions.ChunkedEncodingError):
+            fetch_gtfs_rt_data(url)
+
+    def test_retries_exhausted_raises_request_exception(self, flaky_feed_server):
+        """
+        Test Case ID: TC_018
+        Description: Test that persistent server errors give up once the retry budget is spent.
+        Expected Outcome: A requests RetryError is raised after the configured number of attempts.
+        """
+        url, server = flaky_feed_server(failures=5)
+
+        with pytest.raises(requests.exceptions.RetryError):
+            fetch_gtfs_rt_data(url, retries=2)
+        assert server.request_count == 2
+
+    def test_async_transient_server_errors_are_retried(self, flaky_feed_server):
         """
-        Simulate a successful response.
+        Test Case ID: TC_031
+        Description: Test that the async fetch retries transient server errors like the sync path.
+        Expected Outcome: The 503 responses are retried and the final successful response is parsed.
         """
-        mock_response = Mock()
-        mock_response.status_code = 200
-        mock_response.content = b'\n\x12\x08\x02\x12\x08\x08\x03\x12\x03xyz\x18\x01'  # Example valid content
-        mock_response.headers = {'Content-Type': 'application/x-protobuf'}
-        return mock_response
+        pytest.importorskip('aiohttp')
+        url, server = flaky_feed_server(failures=2)
+
+        results = asyncio.run(fetch_many([url], retries=3))
+
+        assert server.request_count == 3
+        assert results[0]['vehicle']['id'] == 'entity-1'
+
+    def test_async_retries_exhausted_raises_fetch_error(self, flaky_feed_server, caplog):
+        """
+        Test Case ID: TC_032
+        Description: Test that persistent server errors on the async path are reported like sync HTTP errors.
+        Expected Outcome: An exception with 'Error fetching GTFS RT data' is raised and logged after the configured number of attempts.
+        """
+        pytest.importorskip('aiohttp')
+        url, server = flaky_feed_server(failures=5)
+
+        with pytest.raises(Exception, match="Error fetching GTFS RT data"):
+            asyncio.run(fetch_many([url], retries=2))
+        assert server.request_count == 2
+        assert "HTTP error" in caplog.text
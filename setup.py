@@ -0,0 +1,30 @@
+from setuptools import Extension, setup
+
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    # Without Cython, fetch_data falls back to its pure-Python extractor
+    ext_modules = []
+else:
+    ext_modules = cythonize(
+        [
+            Extension(
+                "_fast_extract",
+                sources=["api_handler/_fast_extract.pyx"],
+                extra_compile_args=["-O3"],
+            )
+        ],
+        compiler_directives={"language_level": "3"},
+    )
+
+with open("requirements.txt") as f:
+    install_requires = [line.strip() for line in f if line.strip()]
+
+setup(
+    name="gtfs-rt-pipeline",
+    version="0.1.0",
+    package_dir={"": "api_handler"},
+    py_modules=["fetch_data"],
+    ext_modules=ext_modules,
+    install_requires=install_requires,
+)